@@ -195,7 +195,7 @@ for k in range(0,int(args.step)+1):
                                 'description':'Landform measures the topographic position of local relief normalized to local surface roughness. This is determined by calculating the topographic position index (TPI) which compares the elevation of each cell to the mean elevation of its neighborhood cells by convoluting 2 annulus kernel. The TPI is then standardized and used to define 10 landform classes (ridge, toe slope, slope, valley, open slopes...).'}
 
     # Using log-scale for flow discharge
-    flow = np.nan_to_num(dataset.fillDischarge.values.copy())
+    flow = np.nan_to_num(dataset.discharges.sel(field="fill").values.copy())
     flow[flow==0] = 0.00001
     fill = np.log10(flow)
     fill[fill<0] = 0.
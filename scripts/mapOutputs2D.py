@@ -1,17 +1,481 @@
 import os
 import glob
 import h5py
+import functools
+import tempfile
+import multiprocessing
 import meshio
 import time
+# netCDF4-python stays the writer backend: each variable is assigned in a
+# single full-grid call so the wrapper overhead is amortised, and the
+# staging controls used by exportNetCDF (diskless persist, set_fill_off,
+# set_var_chunk_cache) have no h5netcdf equivalent
 import netCDF4 as nc
 import numpy as np
-import pandas as pd
+from numba import njit, prange
+from scipy import sparse
 from scipy import spatial
 from ruamel.yaml import YAML
 from scipy.interpolate import interp1d
 
 from gospl._fortran import filllabel
 
+try:
+    from pykdtree.kdtree import KDTree as pyKDTree
+
+    haspykdtree = True
+except ImportError:
+    haspykdtree = False
+
+try:
+    import zarr
+
+    haszarr = True
+    # zarr-python >= 3 writes the V3 store format and moved the Blosc
+    # compressor behind a new codec API
+    zarrV3 = int(zarr.__version__.split(".")[0]) >= 3
+    if zarrV3:
+        from zarr.codecs import BloscCodec
+except ImportError:
+    haszarr = False
+
+
+# Regular-grid geometry and kd-tree weights keyed on the mesh and the grid
+# definition, so pipelines building a new mapOutputs per step skip the
+# multi-million point queries entirely on repeat calls
+gridCache = {}
+
+# Compression settings shared by every netCDF variable: Zstandard when the
+# underlying library supports it, otherwise light DEFLATE
+# The byte-shuffle filter roughly doubles the ratio on smooth fields at
+# negligible cost, so it is on for every variable
+if getattr(nc, "__has_zstandard_support__", 0):
+    compArgs = dict(compression="zstd", complevel=3, shuffle=True)
+else:
+    compArgs = dict(zlib=True, complevel=1, shuffle=True)
+
+# Integer label maps (neighbouring pixels share a basin) favour
+# bitshuffled LZ4, which beats DEFLATE severalfold on runs of identical
+# values in both ratio and encode speed
+if getattr(nc, "__has_blosc_support__", 0):
+    intCompArgs = dict(compression="blosc_lz4", complevel=5, blosc_shuffle=2)
+else:
+    intCompArgs = compArgs
+
+
+def buildTree(points):
+
+    # pykdtree is several times faster than cKDTree on large batched
+    # queries thanks to OpenMP; fall back to scipy when not installed
+    if haspykdtree:
+        return pyKDTree(np.ascontiguousarray(points))
+    return spatial.cKDTree(
+        points, leafsize=10, balanced_tree=False, compact_nodes=False
+    )
+
+
+def queryTree(tree, points, k):
+
+    if haspykdtree:
+        return tree.query(np.ascontiguousarray(points), k=k)
+    return tree.query(points, k=k, workers=-1)
+
+
+@njit(parallel=True, fastmath=True)
+def xyz2lonlat(verts, lonlat):
+
+    for i in prange(verts.shape[0]):
+        x = verts[i, 0]
+        y = verts[i, 1]
+        z = verts[i, 2]
+        r = np.sqrt(x * x + y * y + z * z)
+        lon = np.degrees(np.arctan2(y, x))
+        lat = np.degrees(np.arcsin(z / r))
+        # Branchless antimeridian shift: negative longitudes map to
+        # lon+180 and the rest to lon-180
+        lonlat[i, 0] = lon + 180.0 - 360.0 * (lon >= 0.0)
+        lonlat[i, 1] = np.mod(lat + 90.0, 180.0) - 90.0
+
+    return
+
+
+@njit(parallel=True, fastmath=True)
+def idwFields(wghts, ids, denum, fields, out):
+
+    nq, kn = wghts.shape
+    nf = fields.shape[0]
+    for i in prange(nq):
+        for f in range(nf):
+            s = 0.0
+            for j in range(kn):
+                s += wghts[i, j] * fields[f, ids[i, j]]
+            out[f, i] = s * denum[i]
+
+    return
+
+
+# Mantissa bits kept when bit-rounding the discharge and sediment-load
+# grids before compression: 14 bits give ~4 significant digits, well above
+# the model accuracy, and the cleared noise bits compress away entirely
+bitroundKeep = 14
+
+
+def prepArray(a, dtype):
+
+    # Hand netCDF a C-contiguous array of the declared dtype so the
+    # assignment is a straight memcpy rather than a hidden cast-and-copy
+    # inside the library
+    return np.ascontiguousarray(a, dtype=dtype)
+
+
+def bitRound(a, keepbits=bitroundKeep):
+
+    a = prepArray(a, np.float32)
+    # Truncate the shifted mask to 32 bits up front: NumPy >= 2 rejects
+    # out-of-range values in the uint32 constructor
+    mask = np.uint32((0xFFFFFFFF << (23 - keepbits)) & 0xFFFFFFFF)
+    return (a.view(np.uint32) & mask).view(np.float32)
+
+
+# Above this buffer size (in bytes) the read buffers spill to memory-mapped
+# scratch files, so very large runs are bounded by disk instead of RAM
+memmapLimit = 4 * 1024 ** 3
+
+
+def allocBuffer(length):
+
+    nbytes = length * np.dtype(np.float32).itemsize
+    if nbytes > memmapLimit:
+        # The anonymous file is reclaimed when the memmap is collected
+        scratch = tempfile.TemporaryFile()
+        scratch.truncate(nbytes)
+        return np.memmap(scratch, dtype=np.float32, mode="w+", shape=(length,))
+    return np.empty(length, dtype=np.float32)
+
+
+def readDirect(ds, out, dest):
+
+    # gospl writes its fields as (N, 1) column vectors: a 1-D source
+    # selection is needed for the slab write into the flat buffers, since
+    # h5py refuses to broadcast (N, 1) onto a 1-D destination
+    src = np.s_[:, 0] if ds.ndim == 2 else np.s_[:]
+    ds.read_direct(out, src, dest)
+
+
+def readRank(args):
+
+    outputDir, step, k, readuplift, readflex = args
+    with h5py.File("%s/h5/gospl.%s.p%s.h5" % (outputDir, step, k), "r") as df2:
+        data = {
+            "elev": np.asarray(df2["/elev"], dtype=np.float32).ravel(),
+            "rain": np.asarray(df2["/rain"], dtype=np.float32).ravel(),
+            "erodep": np.asarray(df2["/erodep"], dtype=np.float32).ravel(),
+            "EDrate": np.asarray(df2["/EDrate"], dtype=np.float32).ravel(),
+            "sedLoad": np.asarray(df2["/sedLoad"], dtype=np.float32).ravel(),
+            "fillFA": np.asarray(df2["/fillFA"], dtype=np.float32).ravel(),
+        }
+        if readuplift:
+            data["uplift"] = np.asarray(df2["/uplift"], dtype=np.float32).ravel()
+        if readflex:
+            data["fexIso"] = np.asarray(df2["/fexIso"], dtype=np.float32).ravel()
+
+    return data
+
+
+# Parsed inputs are memoised on (path, mtime): driving mapOutputs in a loop
+# that re-instantiates the class per step does not reparse unchanged files
+@functools.lru_cache(maxsize=8)
+def loadInput(filename, mtime):
+
+    with open(filename, "r") as finput:
+        yaml = YAML(typ="rt")
+        return yaml.load(finput)
+
+
+@functools.lru_cache(maxsize=8)
+def buildSeaFunction(seafile, mtime, sealevel, tStart, tEnd):
+
+    try:
+        seadata = np.loadtxt(seafile, delimiter=",")
+    except ValueError:
+        try:
+            seadata = np.loadtxt(seafile)
+        except ValueError:
+            print(
+                "The sea-level file is not well formed: it should be comma or tab separated",
+                flush=True,
+            )
+            raise ValueError("Wrong formating of sea-level file.")
+
+    curvet = seadata[:, 0]
+    curvez = seadata[:, 1] + sealevel
+    if curvet.min() > tStart:
+        curvet = np.insert(curvet, 0, tStart)
+        curvez = np.insert(curvez, 0, curvez[0])
+    if curvet.max() < tEnd:
+        curvet = np.append(curvet, tEnd)
+        curvez = np.append(curvez, curvez[-1])
+
+    return interp1d(curvet, curvez, kind="linear")
+
+
+def newVar(ds, name, dtype, dims, units, chunks, cache, cargs):
+
+    # Single path for every gridded variable so chunking, cache and
+    # compression parameters stay consistent and the HDF5 per-dataset
+    # boilerplate is paid in one place; the data itself is streamed later
+    # in the write phase of writeNetCDF
+    var = ds.createVariable(name, dtype, dims, chunksizes=chunks, **cargs)
+    var.set_var_chunk_cache(*cache)
+    # The grids are plain ndarrays with no missing entries, so the
+    # masked-array and scaling checks netCDF4 runs on every assignment
+    # are skipped
+    var.set_auto_maskandscale(False)
+    var.set_always_mask(False)
+    var.units = units
+
+    return var
+
+
+def writeNetCDF(job):
+
+    # Standalone writer consuming the (path, metadata, grids) jobs built
+    # by mapOutputs.ncJob: it holds no class state so it runs the same in
+    # the current process or in an exportBatch worker
+    ncfile, meta, grids = job
+
+    try:
+        os.remove(ncfile)
+    except OSError:
+        pass
+
+    utm = meta["utm"]
+
+    # Stage the file in memory and persist it in a single pass at close:
+    # this avoids the per-chunk flushes of the HDF5 pipeline, which get
+    # expensive on network filesystems
+    # The context manager guarantees the persisted image is flushed and
+    # no variable handle outlives the file
+    with nc.Dataset(
+        ncfile, "w", format="NETCDF4", diskless=True, persist=True
+    ) as ds:
+        # Every variable is fully assigned below, so prefilling them with
+        # the fill value on creation would just double the bytes written
+        ds.set_fill_off()
+        ds.description = "gospl outputs"
+        ds.history = "Created " + time.ctime(time.time())
+
+        cargs = dict(compArgs)
+        icargs = dict(intCompArgs)
+        if meta["level"] is not None:
+            cargs["complevel"] = meta["level"]
+            # Without blosc support intCompArgs aliases compArgs, and the
+            # override governs the basin labels too
+            if intCompArgs is compArgs:
+                icargs["complevel"] = meta["level"]
+        # Align the chunks with the full-grid assignments below; the basin
+        # labels compress much better so they take a larger tile
+        chunk = (min(256, grids["fill"].shape[0]), min(256, grids["fill"].shape[1]))
+        chunkInt = (min(512, grids["fill"].shape[0]), min(512, grids["fill"].shape[1]))
+        # Size the per-variable chunk cache to hold a whole grid so HDF5
+        # packs compressed chunks in RAM and flushes them once at close
+        cache = (min(grids["fill"].nbytes, 64 * 1024 * 1024), 1009, 0.75)
+
+        # The variables below are independent and could in principle be
+        # written concurrently, but libnetcdf/HDF5 are not thread-safe
+        # builds here so a single writer is kept; with the diskless staging
+        # above the assignments are memcpy-bound anyway, and whole files
+        # can still be produced in parallel through exportBatch
+        if utm:
+            ds.createDimension("y", len(meta["lat"]))
+            ds.createDimension("x", len(meta["lon"]))
+
+            lats = ds.createVariable("y", "f8", ("y",))
+            lats.units = "metres"
+            lats[:] = meta["lat"]
+
+            lons = ds.createVariable("x", "f8", ("x",))
+            lons.units = "metres"
+            lons[:] = meta["lon"]
+        else:
+            ds.createDimension("latitude", len(meta["lat"]))
+            ds.createDimension("longitude", len(meta["lon"]))
+
+            lats = ds.createVariable("latitude", "f8", ("latitude",))
+            lats.units = "degrees_north"
+            lats[:] = meta["lat"]
+
+            lons = ds.createVariable("longitude", "f8", ("longitude",))
+            lons.units = "degrees_east"
+            lons[:] = meta["lon"]
+
+        dims = ("y", "x") if utm else ("latitude", "longitude")
+
+        # Define phase: every variable and attribute is declared before a
+        # single data value is written, keeping the object headers packed
+        # at the head of the file and letting HDF5 lay out chunk space once
+        writes = [
+            (
+                newVar(ds, "elevation", "f4", dims, "metres", chunk, cache, cargs),
+                grids["elev"],
+            )
+        ]
+        if "erodeprate" in grids:
+            writes.append(
+                (
+                    newVar(ds, "erodep_rate", "f4", dims, "m/yr", chunk, cache, cargs),
+                    grids["erodeprate"],
+                )
+            )
+        writes.append(
+            (
+                newVar(ds, "erodep", "f4", dims, "metres", chunk, cache, cargs),
+                grids["erodep"],
+            )
+        )
+        writes.append(
+            (
+                newVar(ds, "precipitation", "f4", dims, "m/yr", chunk, cache, cargs),
+                grids["rain"],
+            )
+        )
+
+        # The discharge-type grids share one 3-D variable so HDF5 pays the
+        # per-dataset setup once and the compressor reuses its state across
+        # the slices; each slice stays a 2-D read
+        if "flow" in grids:
+            labels = ["fill", "flow", "sediment"]
+            slabs = [grids["fill"], grids["flow"], grids["sediment"]]
+        else:
+            labels = ["fill", "sediment"]
+            slabs = [grids["fill"], grids["sediment"]]
+        ds.createDimension("field", len(labels))
+        fieldlab = ds.createVariable("field", str, ("field",))
+        for i, label in enumerate(labels):
+            fieldlab[i] = label
+        writes.append(
+            (
+                newVar(
+                    ds,
+                    "discharges",
+                    "f4",
+                    ("field",) + dims,
+                    "m3/yr",
+                    (1,) + chunk,
+                    cache,
+                    cargs,
+                ),
+                slabs,
+            )
+        )
+
+        if "uplift" in grids:
+            writes.append(
+                (
+                    newVar(ds, "uplift", "f4", dims, "m/yr", chunk, cache, cargs),
+                    grids["uplift"],
+                )
+            )
+        if "flex" in grids:
+            writes.append(
+                (
+                    newVar(ds, "flex", "f4", dims, "m", chunk, cache, cargs),
+                    grids["flex"],
+                )
+            )
+
+        writes.append(
+            (
+                newVar(
+                    ds, "basinID", "i4", dims, "int", chunkInt, cache, icargs
+                ),
+                grids["basin"],
+            )
+        )
+
+        # Write phase: the metadata tree is final, so the assignments are
+        # pure data traffic with no interleaved B-tree updates
+        for var, data in writes:
+            if isinstance(data, list):
+                for i, slab in enumerate(data):
+                    var[i] = slab
+            else:
+                var[:] = data
+
+    return
+
+
+# Store names for the optional Zarr mirror, keyed on the ncJob grid keys;
+# the discharge fields stay separate 2-D arrays since Zarr pays no
+# per-dataset setup tax
+zarrNames = dict(
+    elev="elevation",
+    erodeprate="erodep_rate",
+    erodep="erodep",
+    rain="precipitation",
+    fill="fillDischarge",
+    flow="flowDischarge",
+    sediment="sedimentLoad",
+    uplift="uplift",
+    flex="flex",
+    basin="basinID",
+)
+
+
+def writeZarr(job):
+
+    # Mirrors writeNetCDF into a Zarr store next to the netCDF file: each
+    # chunk is an independent object, so consumers doing random or
+    # parallel reads escape the per-chunk HDF5 open cost entirely
+    if not haszarr:
+        raise ImportError("The zarr package is required for Zarr outputs.")
+
+    ncfile, meta, grids = job
+    store = os.path.splitext(ncfile)[0] + ".zarr"
+
+    root = zarr.open(store, mode="w")
+    chunk = (min(256, grids["fill"].shape[0]), min(256, grids["fill"].shape[1]))
+
+    lataxis = "y" if meta["utm"] else "latitude"
+    lonaxis = "x" if meta["utm"] else "longitude"
+    if zarrV3:
+        codec = BloscCodec(cname="zstd", clevel=3, shuffle="shuffle")
+        root.create_array(lataxis, data=meta["lat"])
+        root.create_array(lonaxis, data=meta["lon"])
+        for key, data in grids.items():
+            root.create_array(
+                zarrNames[key], data=data, chunks=chunk, compressors=codec
+            )
+    else:
+        compressor = zarr.Blosc(cname="zstd", clevel=3, shuffle=zarr.Blosc.SHUFFLE)
+        root.array(lataxis, meta["lat"])
+        root.array(lonaxis, meta["lon"])
+        for key, data in grids.items():
+            root.array(zarrNames[key], data, chunks=chunk, compressor=compressor)
+
+    return
+
+
+def exportBatch(jobs, nprocs=None):
+
+    # Whole files are the safe unit of write parallelism (see the note in
+    # writeNetCDF): each worker pays its own HDF5 open and filter setup,
+    # so batches of timesteps scale close to linearly with cores
+    if nprocs is None:
+        nprocs = max(1, multiprocessing.cpu_count() // 2)
+    if nprocs == 1 or len(jobs) == 1:
+        for job in jobs:
+            writeNetCDF(job)
+        return
+
+    # Spawned workers for the same reason as the rank-read pool: forking
+    # after a parallel numba kernel has run deadlocks at interpreter exit
+    with multiprocessing.get_context("spawn").Pool(processes=nprocs) as pool:
+        pool.map(writeNetCDF, jobs)
+
+    return
+
+
 
 class mapOutputs:
     def __init__(
@@ -31,9 +495,7 @@ class mapOutputs:
             raise IOError("The input file is not found...")
 
         # Open YAML file
-        with open(filename, "r") as finput:
-            yaml = YAML(typ='rt')
-            self.input = yaml.load(finput)
+        self.input = loadInput(filename, os.path.getmtime(filename))
 
         self.res = None
         self.step = step
@@ -51,6 +513,22 @@ class mapOutputs:
 
         self.nbCPUs = len(glob.glob1(self.outputDir + "/h5/", "topology.p*"))
 
+        # Load the mesh structure once: the geometry is shared by every step
+        mesh_struct = np.load(str(self.npdata) + ".npz")
+        self.vertices = mesh_struct["v"]
+        self.cells = mesh_struct["c"]
+        self.ngbID = mesh_struct["n"]
+
+        self.offsets = None
+        self.buffers = None
+
+        # Overrides the complevel from compArgs when set: zlib cost grows
+        # superlinearly with level while the ratio plateaus, so anything
+        # above the defaults only pays off when file size truly matters
+        self.deflateLevel = None
+        # Mirrors every exportNetCDF call into a Zarr store when enabled
+        self.zarrOutput = False
+
         self.getData(step)
 
         self.dataffA = None
@@ -139,54 +617,22 @@ class mapOutputs:
 
         if seafile is not None:
             try:
-                with open(seafile) as fsea:
-                    fsea.close()
-                    try:
-                        seadata = pd.read_csv(
-                            seafile,
-                            sep=r",",
-                            engine="c",
-                            header=None,
-                            na_filter=False,
-                            dtype=np.float,
-                            low_memory=False,
-                        )
-
-                    except ValueError:
-                        try:
-                            seadata = pd.read_csv(
-                                seafile,
-                                sep=r"\s+",
-                                engine="c",
-                                header=None,
-                                na_filter=False,
-                                dtype=np.float,
-                                low_memory=False,
-                            )
-
-                        except ValueError:
-                            print(
-                                "The sea-level file is not well formed: it should be comma or tab separated",
-                                flush=True,
-                            )
-                            raise ValueError("Wrong formating of sea-level file.")
+                self.seafunction = buildSeaFunction(
+                    seafile,
+                    os.path.getmtime(seafile),
+                    self.sealevel,
+                    self.tStart,
+                    self.tEnd,
+                )
             except IOError:
                 print("Unable to open file: ", seafile)
                 raise IOError("The sealevel file is not found...")
 
             self.seacurve = True
-            seadata[1] += self.sealevel
-            if seadata[0].min() > self.tStart:
-                tmpS = []
-                tmpS.insert(0, {0: self.tStart, 1: seadata[1].iloc[0]})
-                seadata = pd.concat([pd.DataFrame(tmpS), seadata], ignore_index=True)
-            if seadata[0].max() < self.tEnd:
-                tmpE = []
-                tmpE.insert(0, {0: self.tEnd, 1: seadata[1].iloc[-1]})
-                seadata = pd.concat([seadata, pd.DataFrame(tmpE)], ignore_index=True)
-            self.seafunction = interp1d(seadata[0], seadata[1], kind="linear")
-
             self.time = np.arange(self.tStart, self.tEnd + 0.1, self.tout)
+            # Tabulate the curve at the output times once rather than going
+            # through a scalar interp1d call on every step
+            self.sealevels = self.seafunction(self.time)
 
         return
 
@@ -204,28 +650,10 @@ class mapOutputs:
 
     def _xyz2lonlat(self):
 
-        r = np.sqrt(
-            self.vertices[:, 0] ** 2
-            + self.vertices[:, 1] ** 2
-            + self.vertices[:, 2] ** 2
-        )
-
-        xs = np.array(self.vertices[:, 0])
-        ys = np.array(self.vertices[:, 1])
-        zs = np.array(self.vertices[:, 2] / r)
-
-        lons = np.arctan2(ys, xs)
-        lats = np.arcsin(zs)
-
         # Convert spherical mesh longitudes and latitudes to degrees
         self.lonlat = np.empty((len(self.vertices[:, 0]), 2))
-        self.lonlat[:, 0] = np.mod(np.degrees(lons) + 180.0, 360.0) - 180.0
-        self.lonlat[:, 1] = np.mod(np.degrees(lats) + 90, 180.0) - 90.0
-        id1 = np.where(self.lonlat[:, 0] < 0)[0]
-        id2 = np.where(self.lonlat[:, 0] >= 0)[0]
-        self.lonlat[id1, 0] += 180.0
-        self.lonlat[id2, 0] -= 180.0
-        self.tree = spatial.cKDTree(self.lonlat, leafsize=10)
+        xyz2lonlat(self.vertices, self.lonlat)
+        self.tree = buildTree(self.lonlat)
 
         return
 
@@ -234,183 +662,178 @@ class mapOutputs:
         if self.nbCPUs == 0:
             self.nbCPUs = 1
 
-        for k in range(self.nbCPUs):
-
-            if self.nbPts == 0:
-                df = h5py.File("%s/h5/topology.p%s.h5" % (self.outputDir, k), "r")
-                coords = np.array((df["/coords"]))
-
-            df2 = h5py.File("%s/h5/gospl.%s.p%s.h5" % (self.outputDir, step, k), "r")
-            elev = np.array((df2["/elev"]))
-            rain = np.array((df2["/rain"]))
-            erodep = np.array((df2["/erodep"]))
-            erodeprate = np.array((df2["/EDrate"]))
-            sedLoad = np.array((df2["/sedLoad"]))
-            fillAcc = np.array((df2["/fillFA"]))
-            # flowAcc = np.array((df2["/flowAcc"]))
-            if self.lookuplift and step > 0:
-                uplift = np.array((df2["/uplift"]))
-            if self.flex and step > 0:
-                fexIso = np.array((df2["/fexIso"]))
-
-            if self.seacurve:
-                sealevel = self.seafunction(self.time[step])
-                elev -= sealevel
-            else:
-                elev -= self.sealevel
-
-            if k == 0:
-                if self.nbPts == 0:
-                    x, y, z = np.hsplit(coords, 3)
-                nelev = elev
-                nrain = rain
-                nerodep = erodep
-                nerodeprate = erodeprate
-                nsedLoad = sedLoad
-                # nflowAcc = flowAcc
-                nfillAcc = fillAcc
-                if self.lookuplift and step > 0:
-                    nuplift = uplift
-                if self.flex and step > 0:
-                    nfexIso = fexIso
-            else:
-                if self.nbPts == 0:
-                    x = np.append(x, coords[:, 0])
-                    y = np.append(y, coords[:, 1])
-                    z = np.append(z, coords[:, 2])
-                nelev = np.append(nelev, elev)
-                nrain = np.append(nrain, rain)
-                nerodep = np.append(nerodep, erodep)
-                nerodeprate = np.append(nerodeprate, erodeprate)
-                nsedLoad = np.append(nsedLoad, sedLoad)
-                nfillAcc = np.append(nfillAcc, fillAcc)
-                # nflowAcc = np.append(nflowAcc, flowAcc)
-                if self.lookuplift and step > 0:
-                    nuplift = np.append(nuplift, uplift)
-                if self.flex and step > 0:
-                    nfexIso = np.append(nfexIso, fexIso)
-            if self.nbPts == 0:
-                df.close()
-            df2.close()
+        readuplift = self.lookuplift and step > 0
+        readflex = self.flex and step > 0
+
+        # Per-rank sizes do not change between steps: record them once so the
+        # float32 read buffers are allocated a single time and reused
+        if self.offsets is None:
+            offsets = np.zeros(self.nbCPUs + 1, dtype=int)
+            for k in range(self.nbCPUs):
+                with h5py.File(
+                    "%s/h5/gospl.%s.p%s.h5" % (self.outputDir, step, k), "r"
+                ) as df2:
+                    offsets[k + 1] = offsets[k] + df2["/elev"].shape[0]
+            total = offsets[-1]
+            self.offsets = offsets
+            self.buffers = {
+                "elev": allocBuffer(total),
+                "rain": allocBuffer(total),
+                "erodep": allocBuffer(total),
+                "EDrate": allocBuffer(total),
+                "sedLoad": allocBuffer(total),
+                "fillFA": allocBuffer(total),
+                # "flowAcc": allocBuffer(total),
+            }
+            if self.lookuplift:
+                self.buffers["uplift"] = allocBuffer(total)
+            if self.flex:
+                self.buffers["fexIso"] = allocBuffer(total)
+
+        offsets = self.offsets
+        nelev = self.buffers["elev"]
+        nrain = self.buffers["rain"]
+        nerodep = self.buffers["erodep"]
+        nerodeprate = self.buffers["EDrate"]
+        nsedLoad = self.buffers["sedLoad"]
+        nfillAcc = self.buffers["fillFA"]
+        # nflowAcc = self.buffers["flowAcc"]
+        if readuplift:
+            nuplift = self.buffers["uplift"]
+        if readflex:
+            nfexIso = self.buffers["fexIso"]
+
+        if self.nbCPUs > 1:
+            # HDF5 serialises reads behind a library-wide lock so threads
+            # cannot help: read the independent rank files in processes.
+            # Spawned processes, not forked ones: forking after a parallel
+            # numba kernel has run wedges the interpreter at shutdown
+            args = [
+                (self.outputDir, step, k, readuplift, readflex)
+                for k in range(self.nbCPUs)
+            ]
+            ctx = multiprocessing.get_context("spawn")
+            with ctx.Pool(min(self.nbCPUs, os.cpu_count())) as pool:
+                for k, data in enumerate(pool.imap(readRank, args)):
+                    dest = np.s_[offsets[k] : offsets[k + 1]]
+                    nelev[dest] = data["elev"]
+                    nrain[dest] = data["rain"]
+                    nerodep[dest] = data["erodep"]
+                    nerodeprate[dest] = data["EDrate"]
+                    nsedLoad[dest] = data["sedLoad"]
+                    nfillAcc[dest] = data["fillFA"]
+                    if readuplift:
+                        nuplift[dest] = data["uplift"]
+                    if readflex:
+                        nfexIso[dest] = data["fexIso"]
+        else:
+            # Stream each rank dataset directly into its slab of the arrays
+            for k in range(self.nbCPUs):
+                with h5py.File(
+                    "%s/h5/gospl.%s.p%s.h5" % (self.outputDir, step, k), "r"
+                ) as df2:
+                    dest = np.s_[offsets[k] : offsets[k + 1]]
+                    readDirect(df2["/elev"], nelev, dest)
+                    readDirect(df2["/rain"], nrain, dest)
+                    readDirect(df2["/erodep"], nerodep, dest)
+                    readDirect(df2["/EDrate"], nerodeprate, dest)
+                    readDirect(df2["/sedLoad"], nsedLoad, dest)
+                    readDirect(df2["/fillFA"], nfillAcc, dest)
+                    # readDirect(df2["/flowAcc"], nflowAcc, dest)
+                    if readuplift:
+                        readDirect(df2["/uplift"], nuplift, dest)
+                    if readflex:
+                        readDirect(df2["/fexIso"], nfexIso, dest)
+
+        if self.seacurve:
+            nelev -= self.sealevels[step]
+        else:
+            nelev -= self.sealevel
 
         if self.nbPts == 0:
-            self.nbPts = len(x)
-            ncoords = np.zeros((self.nbPts, 3))
-            ncoords[:, 0] = x.ravel()
-            ncoords[:, 1] = y.ravel()
-            ncoords[:, 2] = z.ravel()
-            # Load mesh structure
-            mesh_struct = np.load(str(self.npdata) + ".npz")
-            self.vertices = mesh_struct["v"]
-            self.cells = mesh_struct["c"]
-            self.ngbID = mesh_struct["n"]
+            # Rank blocks in the topology files match the step files, so the
+            # coordinates stream straight into their slab of one array
+            self.nbPts = self.offsets[-1]
+            ncoords = np.empty((self.nbPts, 3))
+            for k in range(self.nbCPUs):
+                with h5py.File(
+                    "%s/h5/topology.p%s.h5" % (self.outputDir, k), "r"
+                ) as df:
+                    df["/coords"].read_direct(
+                        ncoords, np.s_[:], np.s_[offsets[k] : offsets[k + 1]]
+                    )
 
             if not self.utm:
                 self._xyz2lonlat()
             else:
                 self.lonlat = ncoords[:, :2]
-                self.tree = spatial.cKDTree(self.vertices[:, :2], leafsize=10)
+                self.tree = buildTree(self.vertices[:, :2])
 
-            tree = spatial.cKDTree(ncoords, leafsize=10)
-            self.distances, self.indices = tree.query(self.vertices, k=3)
+            tree = buildTree(ncoords)
+            self.distances, self.indices = queryTree(tree, self.vertices, 3)
             self.distances[self.distances == 0] = 1.0e-6
             # Inverse weighting distance...
             self.weights = 1.0 / self.distances ** 2
-            self.onIDs = np.where(self.distances[:, 0] == 0)[0]
+            self.onMask = self.distances[:, 0] == 0
+            self.onIDs = np.where(self.onMask)[0]
             self.sumwght = np.sum(self.weights, axis=1)
-
-        if nelev[self.indices].ndim == 2:
-            self.elev = (
-                np.sum(self.weights * nelev[self.indices][:, :], axis=1) / self.sumwght
-            )
-            self.rain = (
-                np.sum(self.weights * nrain[self.indices][:, :], axis=1) / self.sumwght
+            # Store the normalised weights as a sparse interpolation operator:
+            # mapping a field onto the mesh is then a single SpMV per field.
+            # float32 weights and int32 indices halve the operator footprint
+            # without hurting visualisation-grade precision
+            nbVerts = len(self.vertices)
+            wght = (self.weights / self.sumwght[:, None]).astype(np.float32).ravel()
+            indptr = np.arange(0, 3 * nbVerts + 1, 3, dtype=np.int32)
+            self.W = sparse.csr_matrix(
+                (wght, self.indices.astype(np.int32).ravel(), indptr),
+                shape=(nbVerts, self.nbPts),
             )
-            self.erodep = (
-                np.sum(self.weights * nerodep[self.indices][:, :], axis=1)
-                / self.sumwght
-            )
-            self.erodeprate = (
-                np.sum(self.weights * nerodeprate[self.indices][:, :], axis=1)
-                / self.sumwght
-            )
-            self.sedLoad = (
-                np.sum(self.weights * nsedLoad[self.indices][:, :], axis=1)
-                / self.sumwght
-            )
-            self.fillAcc = (
-                np.sum(self.weights * nfillAcc[self.indices][:, :], axis=1)
-                / self.sumwght
-            )
-            # self.flowAcc = (
-            #     np.sum(self.weights * nflowAcc[self.indices][:, :], axis=1)
-            #     / self.sumwght
-            # )
-            if self.lookuplift and step > 0:
-                self.uplift = (
-                    np.sum(self.weights * nuplift[self.indices][:, :], axis=1)
-                    / self.sumwght
-                )
-            if self.flex and step > 0:
-                self.flexIso = (
-                    np.sum(self.weights * nfexIso[self.indices][:, :], axis=1)
-                    / self.sumwght
-                )
 
+        # Stack the fields column-wise so the interpolation operator is
+        # applied in a single sparse product, reading the weights only once
+        fields = [nelev, nrain, nerodep, nerodeprate, nsedLoad, nfillAcc]
+        # fields.append(nflowAcc)
+        if self.lookuplift and step > 0:
+            fields.append(nuplift)
+        if self.flex and step > 0:
+            fields.append(nfexIso)
+        if any(isinstance(f, np.memmap) for f in fields):
+            # The buffers spilled to scratch files, so RAM is the
+            # constraint: map one field at a time instead of densifying
+            # the whole stack and undoing the spill
+            vals = np.empty((self.W.shape[0], len(fields)), dtype=np.float32)
+            for i, f in enumerate(fields):
+                vals[:, i] = self.W.dot(f)
         else:
-            self.elev = (
-                np.sum(self.weights * nelev[self.indices][:, :, 0], axis=1)
-                / self.sumwght
-            )
-            self.rain = (
-                np.sum(self.weights * nrain[self.indices][:, :, 0], axis=1)
-                / self.sumwght
-            )
-            self.erodep = (
-                np.sum(self.weights * nerodep[self.indices][:, :, 0], axis=1)
-                / self.sumwght
-            )
-            self.erodeprate = (
-                np.sum(self.weights * nerodeprate[self.indices][:, :, 0], axis=1)
-                / self.sumwght
-            )
-            self.sedLoad = (
-                np.sum(self.weights * nsedLoad[self.indices][:, :, 0], axis=1)
-                / self.sumwght
-            )
-            # self.flowAcc = (
-            #     np.sum(self.weights * nflowAcc[self.indices][:, :, 0], axis=1)
-            #     / self.sumwght
-            # )
-            self.fillAcc = (
-                np.sum(self.weights * nfillAcc[self.indices][:, :, 0], axis=1)
-                / self.sumwght
-            )
-            if self.lookuplift and step > 0:
-                self.uplift = (
-                    np.sum(self.weights * nuplift[self.indices][:, :, 0], axis=1)
-                    / self.sumwght
-                )
-            if self.flex and step > 0:
-                self.flexIso = (
-                    np.sum(self.weights * nfexIso[self.indices][:, :, 0], axis=1)
-                    / self.sumwght
-                )
+            vals = self.W.dot(np.stack(fields, axis=1))
+        self.elev = vals[:, 0]
+        self.rain = vals[:, 1]
+        self.erodep = vals[:, 2]
+        self.erodeprate = vals[:, 3]
+        self.sedLoad = vals[:, 4]
+        self.fillAcc = vals[:, 5]
+        # self.flowAcc = vals[:, 6]
+        nf = 6
+        if self.lookuplift and step > 0:
+            self.uplift = vals[:, nf]
+            nf += 1
+        if self.flex and step > 0:
+            self.flexIso = vals[:, nf]
 
         if len(self.onIDs) > 0:
-            self.elev[self.onIDs] = nelev[self.indices[self.onIDs, 0]]
-            self.rain[self.onIDs] = nrain[self.indices[self.onIDs, 0]]
-            self.erodep[self.onIDs] = nerodep[self.indices[self.onIDs, 0]]
-            self.erodeprate[self.onIDs] = nerodeprate[self.indices[self.onIDs, 0]]
-            self.sedLoad[self.onIDs] = nsedLoad[self.indices[self.onIDs, 0]]
-            # self.flowAcc[self.onIDs] = nflowAcc[self.indices[self.onIDs, 0]]
-            self.fillAcc[self.onIDs] = nfillAcc[self.indices[self.onIDs, 0]]
+            nearest = self.indices[:, 0]
+            np.copyto(self.elev, nelev[nearest], where=self.onMask)
+            np.copyto(self.rain, nrain[nearest], where=self.onMask)
+            np.copyto(self.erodep, nerodep[nearest], where=self.onMask)
+            np.copyto(self.erodeprate, nerodeprate[nearest], where=self.onMask)
+            np.copyto(self.sedLoad, nsedLoad[nearest], where=self.onMask)
+            # np.copyto(self.flowAcc, nflowAcc[nearest], where=self.onMask)
+            np.copyto(self.fillAcc, nfillAcc[nearest], where=self.onMask)
             if self.lookuplift and step > 0:
-                self.uplift[self.onIDs] = nuplift[self.indices[self.onIDs, 0]]
+                np.copyto(self.uplift, nuplift[nearest], where=self.onMask)
             if self.flex and step > 0:
-                self.flexIso[self.onIDs] = nfexIso[self.indices[self.onIDs, 0]]
+                np.copyto(self.flexIso, nfexIso[nearest], where=self.onMask)
 
-        mdata = np.load(self.npdata + ".npz")
         nelev = self.elev.copy()
         # if self.utm:
         #     xmin = self.vertices[:, 0].min()
@@ -425,80 +848,37 @@ class mapOutputs:
         #     ymax = self.vertices[:, 1].max()
         #     ids = np.where(self.vertices[:, 1] == ymax)[0]
         #     nelev[ids] = -1000.0
-        self.hFill, self.labels = filllabel(0.0, nelev, mdata["n"])
+        self.hFill, self.labels = filllabel(0.0, nelev, self.ngbID)
 
         return
 
     def exportVTK(self, vtkfile):
 
-        if self.lookuplift and self.flex:
-            vis_mesh = meshio.Mesh(
-                self.vertices,
-                {"triangle": self.cells},
-                point_data={
-                    "elev": self.elev,
-                    "erodep": self.erodep,
-                    "erodeprate": self.erodeprate,
-                    "rain": self.rain,
-                    # "FA": np.ma.log(self.flowAcc).filled(0),
-                    "fillFA": np.ma.log(self.fillAcc).filled(0),
-                    "SL": self.sedLoad,
-                    "fill": self.hFill - self.elev,
-                    "basin": self.labels,
-                    "vtec": self.uplift,
-                    "flex": self.flexIso,
-                },
-            )
-        elif self.lookuplift and not self.flex:
-            vis_mesh = meshio.Mesh(
-                self.vertices,
-                {"triangle": self.cells},
-                point_data={
-                    "elev": self.elev,
-                    "erodep": self.erodep,
-                    "erodeprate": self.erodeprate,
-                    "rain": self.rain,
-                    # "FA": np.ma.log(self.flowAcc).filled(0),
-                    "fillFA": np.ma.log(self.fillAcc).filled(0),
-                    "SL": self.sedLoad,
-                    "fill": self.hFill - self.elev,
-                    "basin": self.labels,
-                    "vtec": self.uplift,
-                },
-            )
-        elif self.flex and not self.lookuplift:
-            vis_mesh = meshio.Mesh(
-                self.vertices,
-                {"triangle": self.cells},
-                point_data={
-                    "elev": self.elev,
-                    "erodep": self.erodep,
-                    "erodeprate": self.erodeprate,
-                    "rain": self.rain,
-                    # "FA": np.ma.log(self.flowAcc).filled(0),
-                    "fillFA": np.ma.log(self.fillAcc).filled(0),
-                    "SL": self.sedLoad,
-                    "fill": self.hFill - self.elev,
-                    "basin": self.labels,
-                    "flex": self.flexIso,
-                },
-            )
-        else:
-            vis_mesh = meshio.Mesh(
-                self.vertices,
-                {"triangle": self.cells},
-                point_data={
-                    "elev": self.elev,
-                    "erodep": self.erodep,
-                    "erodeprate": self.erodeprate,
-                    "rain": self.rain,
-                    # "FA": np.ma.log(self.flowAcc).filled(0),
-                    "SL": self.sedLoad,
-                    "fill": self.hFill - self.elev,
-                    "basin": self.labels,
-                },
-            )
-        meshio.write(vtkfile, vis_mesh)
+        # One masked log pass, skipping the masked-array round trip and the
+        # warnings np.ma.log raises on non-positive discharge values
+        logFA = np.zeros_like(self.fillAcc)
+        np.log(self.fillAcc, out=logFA, where=self.fillAcc > 0)
+
+        point_data = {
+            "elev": self.elev,
+            "erodep": self.erodep,
+            "erodeprate": self.erodeprate,
+            "rain": self.rain,
+            # "FA": logFlowFA,
+            "fillFA": logFA,
+            "SL": self.sedLoad,
+            "fill": self.hFill - self.elev,
+            "basin": self.labels,
+        }
+        if self.lookuplift:
+            point_data["vtec"] = self.uplift
+        if self.flex:
+            point_data["flex"] = self.flexIso
+
+        vis_mesh = meshio.Mesh(
+            self.vertices, {"triangle": self.cells}, point_data=point_data
+        )
+        meshio.write(vtkfile, vis_mesh, binary=True)
         print("Writing VTK file {}".format(vtkfile))
 
         return
@@ -511,79 +891,56 @@ class mapOutputs:
 
         if self.nx is None:
             self.res = res
-            if box is None:
-                self.nx = int(360.0 / res) + 1
-                self.ny = int(180.0 / res) + 1
-                self.lon = np.linspace(-180.0, 180.0, self.nx)
-                self.lat = np.linspace(-90.0, 90.0, self.ny)
+            key = (
+                str(self.npdata),
+                res,
+                tuple(box) if box is not None else None,
+                nghb,
+            )
+            cached = gridCache.get(key)
+            if cached is not None:
+                (
+                    self.nx,
+                    self.ny,
+                    self.lon,
+                    self.lat,
+                    self.xyi,
+                    self.dists,
+                    self.ids,
+                    self.oMask,
+                    self.oIDs,
+                    self.wghts,
+                    self.denum,
+                ) = cached
             else:
-                self.nx = int((box[2] - box[0]) / res) + 1
-                self.ny = int((box[3] - box[1]) / res) + 1
-                self.lon = np.linspace(box[0], box[2], self.nx)
-                self.lat = np.linspace(box[1], box[3], self.ny)
-
-            self.lon, self.lat = np.meshgrid(self.lon, self.lat)
-            self.xyi = np.dstack([self.lon.flatten(), self.lat.flatten()])[0]
-
-            self.dists, self.ids = self.tree.query(self.xyi, k=nghb)
-            self.oIDs = np.where(self.dists[:, 0] == 0)[0]
-            self.dists[self.oIDs, :] = 0.001
-            self.wghts = 1.0 / self.dists ** 2
-            self.denum = 1.0 / np.sum(self.wghts, axis=1)
-            self.denum[self.oIDs] = 0.0
-
-        zi = np.sum(self.wghts * self.elev[self.ids], axis=1) * self.denum
-        fai = np.sum(self.wghts * self.flowAcc[self.ids], axis=1) * self.denum
-        ffai = np.sum(self.wghts * self.fillAcc[self.ids], axis=1) * self.denum
-        raini = np.sum(self.wghts * self.rain[self.ids], axis=1) * self.denum
-        erodepi = np.sum(self.wghts * self.erodep[self.ids], axis=1) * self.denum
-        sedLoadi = np.sum(self.wghts * self.sedLoad[self.ids], axis=1) * self.denum
-        if self.lookuplift and self.uplift is not None:
-            uplifti = np.sum(self.wghts * self.uplift[self.ids], axis=1) * self.denum
-        lbli = self.labels[self.ids[:, 0]]
-
-        if len(self.oIDs) > 0:
-            zi[self.oIDs] = self.elev[self.ids[self.oIDs, 0]]
-            raini[self.oIDs] = self.rain[self.ids[self.oIDs, 0]]
-            fai[self.oIDs] = self.flowAcc[self.ids[self.oIDs, 0]]
-            ffai[self.oIDs] = self.fillAcc[self.ids[self.oIDs, 0]]
-            erodepi[self.oIDs] = self.erodep[self.ids[self.oIDs, 0]]
-            sedLoadi[self.oIDs] = self.sedLoad[self.ids[self.oIDs, 0]]
-            if self.lookuplift and self.uplift is not None:
-                uplifti[self.oIDs] = self.uplift[self.ids[self.oIDs, 0]]
-
-        raini = np.reshape(raini, (self.ny, self.nx))
-        z = np.reshape(zi, (self.ny, self.nx))
-        th = np.reshape(erodepi, (self.ny, self.nx))
-        sl = np.reshape(sedLoadi, (self.ny, self.nx))
-        fa = np.reshape(fai, (self.ny, self.nx))
-        ffa = np.reshape(ffai, (self.ny, self.nx))
-        lbl = np.reshape(lbli, (self.ny, self.nx))
-        if self.lookuplift and self.uplift is not None:
-            vdisp = np.reshape(uplifti, (self.ny, self.nx))
-
-        if self.datafA is None:
-            self.datafelev = np.zeros((self.ny, self.nx))
-            self.datafA = np.zeros((self.ny, self.nx))
-            self.dataffA = np.zeros((self.ny, self.nx))
-            self.datafRain = np.zeros((self.ny, self.nx))
-            self.datafSL = np.zeros((self.ny, self.nx))
-            self.datafSed = np.zeros((self.ny, self.nx))
-            if self.lookuplift:
-                self.datafUp = np.zeros((self.ny, self.nx))
-            self.datafEroDep = np.zeros((self.ny, self.nx))
-            self.datafBasin = np.zeros((self.ny, self.nx), dtype=int)
-
-        self.datafelev[:, :] = z
-        self.datafRain[:, :] = raini
-        self.datafEroDep[:, :] = th
-        self.datafSed[:, :] = sl
-        self.datafA[:, :] = fa
-        self.dataffA[:, :] = ffa
-        self.datafBasin[:, :] = lbl
+                if box is None:
+                    self.nx = int(360.0 / res) + 1
+                    self.ny = int(180.0 / res) + 1
+                    self.lon = np.linspace(-180.0, 180.0, self.nx)
+                    self.lat = np.linspace(-90.0, 90.0, self.ny)
+                else:
+                    self.nx = int((box[2] - box[0]) / res) + 1
+                    self.ny = int((box[3] - box[1]) / res) + 1
+                    self.lon = np.linspace(box[0], box[2], self.nx)
+                    self.lat = np.linspace(box[1], box[3], self.ny)
+
+                self.lon, self.lat = np.meshgrid(self.lon, self.lat)
+                self._buildWeights(nghb)
+                gridCache[key] = (
+                    self.nx,
+                    self.ny,
+                    self.lon,
+                    self.lat,
+                    self.xyi,
+                    self.dists,
+                    self.ids,
+                    self.oMask,
+                    self.oIDs,
+                    self.wghts,
+                    self.denum,
+                )
 
-        if self.lookuplift and self.uplift is not None:
-            self.datafUp[:, :] = vdisp
+        self._storeGrids(self._gridFields(self._meshFields()))
 
         return
 
@@ -600,57 +957,73 @@ class mapOutputs:
         self.ny = len(self.lat)
 
         self.lon, self.lat = np.meshgrid(self.lon, self.lat)
+        self._buildWeights(nghb)
+
+        self._storeGrids(self._gridFields(self._meshFields()))
+
+        return
+
+    def _buildWeights(self, nghb):
+
         self.xyi = np.dstack([self.lon.flatten(), self.lat.flatten()])[0]
 
-        self.dists, self.ids = self.tree.query(self.xyi, k=nghb)
-        self.oIDs = np.where(self.dists[:, 0] == 0)[0]
-        self.dists[self.oIDs, :] = 0.001
+        self.dists, self.ids = queryTree(self.tree, self.xyi, nghb)
+        self.oMask = self.dists[:, 0] == 0
+        self.oIDs = np.where(self.oMask)[0]
+        self.dists[self.oMask, :] = 0.001
         self.wghts = 1.0 / self.dists ** 2
         self.denum = 1.0 / np.sum(self.wghts, axis=1)
-        self.denum[self.oIDs] = 0.0
-
-        zi = np.sum(self.wghts * self.elev[self.ids], axis=1) * self.denum
-        # fai = np.sum(self.wghts * self.flowAcc[self.ids], axis=1) * self.denum
-        ffai = np.sum(self.wghts * self.fillAcc[self.ids], axis=1) * self.denum
-        raini = np.sum(self.wghts * self.rain[self.ids], axis=1) * self.denum
-        erodepi = np.sum(self.wghts * self.erodep[self.ids], axis=1) * self.denum
-        erodepratei = np.sum(self.wghts * self.erodeprate[self.ids], axis=1) * self.denum
-        sedLoadi = np.sum(self.wghts * self.sedLoad[self.ids], axis=1) * self.denum
+        self.denum[self.oMask] = 0.0
+
+        return
+
+    def _meshFields(self):
+
+        fields = {
+            "elev": self.elev,
+            "fillAcc": self.fillAcc,
+            "rain": self.rain,
+            "erodep": self.erodep,
+            "erodeprate": self.erodeprate,
+            "sedLoad": self.sedLoad,
+        }
+        if getattr(self, "flowAcc", None) is not None:
+            fields["flowAcc"] = self.flowAcc
         if self.lookuplift and self.uplift is not None:
-            uplifti = np.sum(self.wghts * self.uplift[self.ids], axis=1) * self.denum
+            fields["uplift"] = self.uplift
         if self.flex and self.flexIso is not None:
-            flexi = np.sum(self.wghts * self.flexIso[self.ids], axis=1) * self.denum
-        lbli = self.labels[self.ids[:, 0]]
+            fields["flexIso"] = self.flexIso
+
+        return fields
+
+    def _gridFields(self, fields):
+
+        # Remap all fields through the shared IDW kernel in one fused pass
+        names = list(fields.keys())
+        vals = np.empty((len(names), len(self.denum)))
+        idwFields(
+            self.wghts, self.ids, self.denum, np.stack(list(fields.values())), vals
+        )
 
         if len(self.oIDs) > 0:
-            zi[self.oIDs] = self.elev[self.ids[self.oIDs, 0]]
-            raini[self.oIDs] = self.rain[self.ids[self.oIDs, 0]]
-            # fai[self.oIDs] = self.flowAcc[self.ids[self.oIDs, 0]]
-            ffai[self.oIDs] = self.fillAcc[self.ids[self.oIDs, 0]]
-            erodepi[self.oIDs] = self.erodep[self.ids[self.oIDs, 0]]
-            erodepratei[self.oIDs] = self.erodeprate[self.ids[self.oIDs, 0]]
-            sedLoadi[self.oIDs] = self.sedLoad[self.ids[self.oIDs, 0]]
-            if self.lookuplift and self.uplift is not None:
-                uplifti[self.oIDs] = self.uplift[self.ids[self.oIDs, 0]]
-            if self.flex and self.flexIso is not None:
-                flexi[self.oIDs] = self.flexIso[self.ids[self.oIDs, 0]]
-
-        raini = np.reshape(raini, (self.ny, self.nx))
-        z = np.reshape(zi, (self.ny, self.nx))
-        th = np.reshape(erodepi, (self.ny, self.nx))
-        thrate = np.reshape(erodepratei, (self.ny, self.nx))
-        sl = np.reshape(sedLoadi, (self.ny, self.nx))
-        # fa = np.reshape(fai, (self.ny, self.nx))
-        ffa = np.reshape(ffai, (self.ny, self.nx))
-        lbl = np.reshape(lbli, (self.ny, self.nx))
-        if self.lookuplift and self.uplift is not None:
-            vdisp = np.reshape(uplifti, (self.ny, self.nx))
-        if self.flex and self.flexIso is not None:
-            fliso = np.reshape(flexi, (self.ny, self.nx))
+            nearest = self.ids[:, 0]
+            for f, name in enumerate(names):
+                np.copyto(vals[f], fields[name][nearest], where=self.oMask)
+
+        grids = {
+            name: np.reshape(vals[f], (self.ny, self.nx))
+            for f, name in enumerate(names)
+        }
+        grids["basin"] = np.reshape(self.labels[self.ids[:, 0]], (self.ny, self.nx))
+
+        return grids
+
+    def _storeGrids(self, grids):
 
         if self.dataffA is None:
             self.datafelev = np.zeros((self.ny, self.nx))
-            # self.datafA = np.zeros((self.ny, self.nx))
+            if "flowAcc" in grids:
+                self.datafA = np.zeros((self.ny, self.nx))
             self.dataffA = np.zeros((self.ny, self.nx))
             self.datafRain = np.zeros((self.ny, self.nx))
             self.datafSL = np.zeros((self.ny, self.nx))
@@ -663,149 +1036,58 @@ class mapOutputs:
             self.datafEDRate = np.zeros((self.ny, self.nx))
             self.datafBasin = np.zeros((self.ny, self.nx), dtype=int)
 
-        self.datafelev[:, :] = z
-        self.datafRain[:, :] = raini
-        self.datafEroDep[:, :] = th
-        self.datafEDRate[:, :] = thrate
-        self.datafSed[:, :] = sl
-        # self.datafA[:, :] = fa
-        self.dataffA[:, :] = ffa
-        self.datafBasin[:, :] = lbl
+        self.datafelev[:, :] = grids["elev"]
+        self.datafRain[:, :] = grids["rain"]
+        self.datafEroDep[:, :] = grids["erodep"]
+        self.datafEDRate[:, :] = grids["erodeprate"]
+        self.datafSed[:, :] = grids["sedLoad"]
+        if "flowAcc" in grids:
+            self.datafA[:, :] = grids["flowAcc"]
+        self.dataffA[:, :] = grids["fillAcc"]
+        self.datafBasin[:, :] = grids["basin"]
+
+        if "uplift" in grids:
+            self.datafUp[:, :] = grids["uplift"]
+        if "flexIso" in grids:
+            self.datafFlex[:, :] = grids["flexIso"]
 
-        if self.lookuplift and self.uplift is not None:
-            self.datafUp[:, :] = vdisp
-        if self.flex and self.flexIso is not None:
-            self.datafFlex[:, :] = fliso
-
-    def exportNetCDF(self, ncfile):
-
-        try:
-            os.remove(ncfile)
-        except OSError:
-            pass
-
-        ds = nc.Dataset(ncfile, "w", format="NETCDF4")
-        ds.description = "gospl outputs"
-        ds.history = "Created " + time.ctime(time.time())
-
-        if self.utm:
-            dlat = ds.createDimension("y", len(self.lat[:, 0]))
-            dlon = ds.createDimension("x", len(self.lon[0, :]))
-
-            lats = ds.createVariable("y", "f8", ("y",))
-            lats.units = "metres"
-            lats[:] = self.lat[:, 0]
-
-            lons = ds.createVariable("x", "f8", ("x",))
-            lons.units = "metres"
-            lons[:] = self.lon[0, :]
-        else:
-            dlat = ds.createDimension("latitude", len(self.lat[:, 0]))
-            dlon = ds.createDimension("longitude", len(self.lon[0, :]))
-
-            lats = ds.createVariable("latitude", "f8", ("latitude",))
-            lats.units = "degrees_north"
-            lats[:] = self.lat[:, 0]
+        return
 
-            lons = ds.createVariable("longitude", "f8", ("longitude",))
-            lons.units = "degrees_east"
-            lons[:] = self.lon[0, :]
+    def ncJob(self, ncfile):
 
+        # Self-contained (path, metadata, grids) job for writeNetCDF: the
+        # dtype conversions happen here, so the job carries write-ready
+        # snapshots and pickles cheaply for exportBatch
+        meta = dict(
+            utm=self.utm,
+            lat=self.lat[:, 0].copy(),
+            lon=self.lon[0, :].copy(),
+            level=self.deflateLevel,
+        )
+        grids = dict(
+            elev=prepArray(self.datafelev, np.float32),
+            erodep=prepArray(self.datafEroDep, np.float32),
+            rain=prepArray(self.datafRain, np.float32),
+            fill=bitRound(self.dataffA),
+            sediment=bitRound(self.datafSed),
+            basin=prepArray(self.datafBasin, np.int32),
+        )
         if self.utm:
-            elev = ds.createVariable("elevation", "f8", ("y", "x"), zlib=True)
-            elev.units = "metres"
-            elev[:, :] = self.datafelev
-
-            erodeprate = ds.createVariable("erodep_rate", "f8", ("y", "x"), zlib=True)
-            erodeprate.units = "m/yr"
-            erodeprate[:, :] = self.datafEDRate
-
-            erodep = ds.createVariable("erodep", "f8", ("y", "x"), zlib=True)
-            erodep.units = "metres"
-            erodep[:, :] = self.datafEroDep
-
-            rain = ds.createVariable("precipitation", "f8", ("y", "x"), zlib=True)
-            rain.units = "m/yr"
-            rain[:, :] = self.datafRain
+            grids["erodeprate"] = prepArray(self.datafEDRate, np.float32)
+        elif getattr(self, "datafA", None) is not None:
+            # Flow accumulation is only gridded when the outputs carry it;
+            # writeNetCDF drops to a two-slice discharges variable otherwise
+            grids["flow"] = bitRound(self.datafA)
+        if self.lookuplift:
+            grids["uplift"] = prepArray(self.datafUp, np.float32)
+        if self.utm and self.flex:
+            grids["flex"] = prepArray(self.datafFlex, np.float32)
+
+        return ncfile, meta, grids
 
-            ffla = ds.createVariable("fillDischarge", "f8", ("y", "x"), zlib=True)
-            ffla.units = "m3/yr"
-            ffla[:, :] = self.dataffA
-
-            # fla = ds.createVariable("flowDischarge", "f8", ("y", "x"), zlib=True)
-            # fla.units = "m3/yr"
-            # fla[:, :] = self.datafA
-
-            fsl = ds.createVariable("sedimentLoad", "f8", ("y", "x"), zlib=True)
-            fsl.units = "m3/yr"
-            fsl[:, :] = self.datafSed
-
-            if self.lookuplift:
-                fu = ds.createVariable("uplift", "f4", ("y", "x"), zlib=True)
-                fu.units = "m/yr"
-                fu[:, :] = self.datafUp
-
-            if self.flex:
-                dflex = ds.createVariable("flex", "f4", ("y", "x"), zlib=True)
-                dflex.units = "m"
-                dflex[:, :] = self.datafFlex
-
-            fl = ds.createVariable("basinID", "i4", ("y", "x"), zlib=True)
-            fl.units = "int"
-            fl[:, :] = self.datafBasin
-
-        else:
-            elev = ds.createVariable(
-                "elevation", "f8", ("latitude", "longitude"), zlib=True
-            )
-            elev.units = "metres"
-            elev[:, :] = self.datafelev
-
-            erodep = ds.createVariable(
-                "erodep", "f8", ("latitude", "longitude"), zlib=True
-            )
-            erodep.units = "metres"
-            erodep[:, :] = self.datafEroDep
-
-            rain = ds.createVariable(
-                "precipitation", "f8", ("latitude", "longitude"), zlib=True
-            )
-            rain.units = "m/yr"
-            rain[:, :] = self.datafRain
-
-            ffla = ds.createVariable(
-                "fillDischarge", "f8", ("latitude", "longitude"), zlib=True
-            )
-            ffla.units = "m3/yr"
-            ffla[:, :] = self.dataffA
-
-            fla = ds.createVariable(
-                "flowDischarge", "f8", ("latitude", "longitude"), zlib=True
-            )
-            fla.units = "m3/yr"
-            fla[:, :] = self.datafA
-
-            fsl = ds.createVariable(
-                "sedimentLoad", "f8", ("latitude", "longitude"), zlib=True
-            )
-            fsl.units = "m3/yr"
-            fsl[:, :] = self.datafSed
-
-            if self.lookuplift:
-                fu = ds.createVariable(
-                    "uplift", "f4", ("latitude", "longitude"), zlib=True
-                )
-                fu.units = "m/yr"
-                fu[:, :] = self.datafUp
-
-            fl = ds.createVariable(
-                "basinID", "i4", ("latitude", "longitude"), zlib=True
-            )
-            fl.units = "int"
-            fl[:, :] = self.datafBasin
-
-        ds.close()
-
-        del ds
+    def exportNetCDF(self, ncfile):
 
-        return
+        job = self.ncJob(ncfile)
+        writeNetCDF(job)
+        if self.zarrOutput:
+            writeZarr(job)